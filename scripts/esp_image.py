@@ -0,0 +1,117 @@
+"""Helpers for building target/esp.img, shared by flash.py and run.py."""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+ESP_SIZE = 100 * 1024 * 1024
+ESP_IMG = Path("target/esp.img")
+ESP_TMP = Path("target/esp.img.tmp")
+ESP_STAMP = Path("target/esp.img.stamp")
+
+
+def esp_stamp(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def read_stamp(stamp_path: Path) -> str | None:
+    try:
+        return stamp_path.read_text().strip()
+    except OSError:
+        return None
+
+
+def write_small(path: Path, data: bytes) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def fresh_image(img: Path) -> None:
+    # qemu-img's raw format is just a sparse file, so create one directly.
+    fd = os.open(img, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, ESP_SIZE)
+    finally:
+        os.close(fd)
+    subprocess.run(
+        ["mformat", "-i", str(img), "-F", "::"], check=True, stdout=subprocess.DEVNULL
+    )
+
+
+def make_staging_dir() -> Path:
+    # Prefer tmpfs so staged files are only written to disk once, inside esp.img.
+    try:
+        staging = tempfile.mkdtemp(prefix="esp-", dir="/dev/shm")
+    except OSError:
+        # No /dev/shm (macOS) or not writable (locked-down containers).
+        staging = tempfile.mkdtemp(prefix="esp-")
+    (Path(staging) / "EFI" / "BOOT").mkdir(parents=True)
+    return Path(staging)
+
+
+def build_esp_image(
+    src_efi: Path,
+    extras: Sequence[bytes],
+    build: Callable[[], object],
+    populate: Callable[[Path], None],
+) -> None:
+    # The stamp covers the built src_efi plus extras; on rebuild, populate
+    # fills a fresh staging dir that is then copied into the image.
+    ESP_IMG.parent.mkdir(parents=True, exist_ok=True)
+
+    def current_stamp() -> str:
+        return esp_stamp(src_efi.read_bytes(), *extras)
+
+    recorded = read_stamp(ESP_STAMP) if ESP_IMG.exists() else None
+    try:
+        prebuild = current_stamp()
+    except OSError:
+        prebuild = None
+
+    # If a rebuild looks likely, prepare the blank FAT image while the build
+    # runs. Otherwise leave it alone so the up-to-date path stays free of it.
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fut_img = None
+        if recorded is None or recorded != prebuild:
+            fut_img = ex.submit(fresh_image, ESP_TMP)
+        build()
+        if fut_img:
+            fut_img.result()
+
+    stamp = current_stamp()
+    if recorded == stamp:
+        print("ESP image is up to date.")
+        if fut_img:
+            ESP_TMP.unlink(missing_ok=True)
+        return
+
+    if not fut_img:
+        fresh_image(ESP_TMP)
+    ESP_STAMP.unlink(missing_ok=True)
+
+    staging = make_staging_dir()
+    try:
+        populate(staging)
+        items = [str(item) for item in staging.iterdir()]
+        subprocess.run(["mcopy", "-i", str(ESP_TMP), "-s", *items, "::"], check=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    os.replace(ESP_TMP, ESP_IMG)
+
+    ESP_STAMP.write_text(stamp + "\n")
@@ -3,19 +3,38 @@
 from __future__ import annotations
 
 import argparse
-import json
+import functools
 import os
 import platform
-import re
+import plistlib
 import shlex
 import shutil
+import stat
 import subprocess
 import sys
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from pathlib import Path
+from xml.parsers.expat import ExpatError
 
+from esp_image import build_esp_image, write_small
 
-def run(cmd: list[str] | str, check: bool = True) -> subprocess.CompletedProcess:
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+
+RAW_CHUNK = 4 * 1024 * 1024
+RAW_DEPTH = 8
+DISK_CACHE_TTL = 1.0
+
+
+def run(
+    cmd: list[str] | str, check: bool = True, capture: bool = True
+) -> subprocess.CompletedProcess:
     if isinstance(cmd, str):
         shell = True
         printable = cmd
@@ -23,21 +42,27 @@ def run(cmd: list[str] | str, check: bool = True) -> subprocess.CompletedProcess
         shell = False
         printable = " ".join(shlex.quote(c) for c in cmd)
     try:
+        # stderr stays piped either way so failures can still be reported.
         return subprocess.run(
             cmd,
             shell=shell,
             check=check,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
             stderr=subprocess.PIPE,
-            text=True,
         )
     except subprocess.CalledProcessError as e:
         print(f"Command failed: {printable}", file=sys.stderr)
-        print(e.stdout, file=sys.stderr)
-        print(e.stderr, file=sys.stderr)
+        if e.stdout:
+            print(e.stdout.decode(errors="replace"), file=sys.stderr)
+        print(e.stderr.decode(errors="replace"), file=sys.stderr)
         raise
 
 
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> str | None:
+    return shutil.which(name)
+
+
 @dataclass
 class Disk:
     path: str
@@ -47,50 +72,137 @@ class Disk:
     transport: str
     removable: bool
     internal: bool
+    mountpoints: tuple[str, ...] = ()
+
+
+_disk_cache: dict[str, tuple[float, list[Disk]]] = {}
+
+
+def _cached_disks(fn: Callable[[], list[Disk]]) -> Callable[[], list[Disk]]:
+    @functools.wraps(fn)
+    def wrapper() -> list[Disk]:
+        now = time.monotonic()
+        hit = _disk_cache.get(fn.__name__)
+        if hit and now - hit[0] < DISK_CACHE_TTL:
+            return list(hit[1])
+        disks = fn()
+        _disk_cache[fn.__name__] = (now, disks)
+        return list(disks)
+
+    return wrapper
 
 
+def _human_size(n: int) -> str:
+    if n < 1000:
+        return f"{n} B"
+    size = float(n)
+    for unit in ("KB", "MB", "GB", "TB"):
+        size /= 1000
+        if size < 1000:
+            break
+    return f"{size:.1f} {unit}"
+
+
+def _iter_plists(out: bytes) -> Iterator[dict]:
+    # `diskutil info -plist -all` may emit one plist per disk, possibly with
+    # separator lines between them, so frame each document explicitly.
+    pos = 0
+    while True:
+        starts = [out.find(b"<?xml", pos), out.find(b"<plist", pos)]
+        starts = [i for i in starts if i >= 0]
+        if not starts:
+            return
+        begin = min(starts)
+        end = out.find(b"</plist>", begin)
+        if end == -1:
+            return
+        end += len(b"</plist>")
+        pos = end
+        try:
+            value = plistlib.loads(out[begin:end])
+        except (plistlib.InvalidFileException, ExpatError):
+            continue
+        if isinstance(value, dict):
+            yield value
+
+
+def _probe_macos_disk(dev: str) -> dict | None:
+    out = run(["diskutil", "info", "-plist", f"/dev/{dev}"], check=False).stdout
+    return next(_iter_plists(out), None)
+
+
+@_cached_disks
 def list_disks_macos() -> list[Disk]:
-    out = run(["diskutil", "list"]).stdout
+    # The batched info call doesn't need the listing, so run both at once.
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fut_info = ex.submit(run, ["diskutil", "info", "-plist", "-all"], check=False)
+        listing = plistlib.loads(run(["diskutil", "list", "-plist"]).stdout)
+        out = fut_info.result().stdout
+    entries = [
+        e for e in listing.get("AllDisksAndPartitions", []) if e.get("DeviceIdentifier")
+    ]
+    infos: dict[str, dict] = {}
+    for info in _iter_plists(out):
+        if info.get("DeviceIdentifier"):
+            infos[info["DeviceIdentifier"]] = info
+    # Probe whatever the batched call missed; the calls are independent.
+    missing = [
+        e["DeviceIdentifier"] for e in entries if e["DeviceIdentifier"] not in infos
+    ]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(16, len(missing))) as ex:
+            for dev, info in zip(missing, ex.map(_probe_macos_disk, missing)):
+                if info:
+                    infos[dev] = info
     disks: list[Disk] = []
-    header_re = re.compile(r"^/dev/(disk\d+) \(([^)]*)\):\s*$")
-    size_re = re.compile(r"^\s*#: +TYPE +NAME +SIZE .*?\n")
-    current = None
-    for line in out.splitlines():
-        m = header_re.match(line.strip())
-        if m:
-            dev = m.group(1)
-            flags = m.group(2)
-            internal = "internal" in flags
-            external = "external" in flags
-            info = run(["diskutil", "info", f"/dev/{dev}"], check=False).stdout
-            size_match = re.search(r"Disk Size:\s*([0-9.]+\s*[A-Z]+)", info)
-            size = size_match.group(1) if size_match else "?"
-            model_match = re.search(r"Device / Media Name:\s*(.*)", info)
-            model = (model_match.group(1).strip() if model_match else "").strip()
-            transport_match = re.search(r"Protocol:\s*(.*)", info)
-            transport = (
-                transport_match.group(1).strip() if transport_match else ""
-            ).strip()
-            disks.append(
-                Disk(
-                    path=f"/dev/{dev}",
-                    display_path=f"/dev/r{dev}",
-                    size=size,
-                    model=model or dev,
-                    transport=transport or ("USB" if external else ""),
-                    removable=external,
-                    internal=internal,
-                )
+    for entry in entries:
+        dev = entry["DeviceIdentifier"]
+        # Only trust the removable/internal flags when diskutil info knew the disk.
+        known = dev in infos
+        info = {**entry, **infos.get(dev, {})}
+        internal = bool(info.get("Internal"))
+        external = known and (
+            bool(info.get("RemovableMedia"))
+            or (not internal and info.get("VirtualOrPhysical") != "Virtual")
+        )
+        # TotalSize is the whole media; list entries only carry Size.
+        size = info.get("TotalSize") or info.get("Size")
+        disks.append(
+            Disk(
+                path=f"/dev/{dev}",
+                display_path=f"/dev/r{dev}",
+                size=_human_size(size) if size else "?",
+                model=(info.get("MediaName") or "").strip() or dev,
+                transport=(info.get("BusProtocol") or "").strip()
+                or ("USB" if external else ""),
+                removable=external,
+                internal=internal,
             )
+        )
     return disks
 
 
+def _collect_mountpoints(dev: dict) -> list[str]:
+    # MOUNTPOINTS lists every mount of a device; MOUNTPOINT only the first.
+    mps = dev.get("mountpoints") or [dev.get("mountpoint")]
+    found = [mp for mp in mps if mp]
+    for ch in dev.get("children", []) or []:
+        found.extend(_collect_mountpoints(ch))
+    return found
+
+
+@_cached_disks
 def list_disks_linux() -> list[Disk]:
-    if not shutil.which("lsblk"):
+    if not _which("lsblk"):
         print("lsblk not found. Please install util-linux.", file=sys.stderr)
         return []
-    res = run(["lsblk", "-J", "-o", "NAME,KNAME,TYPE,RM,SIZE,MODEL,TRAN,VENDOR"]).stdout
-    data = json.loads(res)
+    columns = "NAME,KNAME,TYPE,RM,SIZE,MODEL,TRAN,VENDOR"
+    proc = run(["lsblk", "-J", "-o", f"{columns},MOUNTPOINTS"], check=False)
+    if proc.returncode != 0:
+        # util-linux before 2.37 has no MOUNTPOINTS column.
+        proc = run(["lsblk", "-J", "-o", f"{columns},MOUNTPOINT"])
+    res = proc.stdout
+    data = _json.loads(res)
     disks: list[Disk] = []
     for dev in data.get("blockdevices", []):
         if dev.get("type") != "disk":
@@ -110,35 +222,29 @@ def list_disks_linux() -> list[Disk]:
                 transport=transport,
                 removable=removable,
                 internal=not removable,
+                mountpoints=tuple(_collect_mountpoints(dev)),
             )
         )
     return disks
 
 
 def ensure_image(path: Path) -> None:
-    print("Building UEFI image...")
-    run(
-        ["cargo", "build", "-p", "zap", "--target", "x86_64-unknown-uefi"],
-    )
-
-    esp_dir = Path("target/esp")
-    if esp_dir.exists():
-        shutil.rmtree(esp_dir)
-
-    esp_boot_dir = esp_dir / "EFI" / "BOOT"
-    esp_boot_dir.mkdir(parents=True)
-
     src_efi = Path("target/x86_64-unknown-uefi/debug/zap.efi")
-    dst_efi = esp_boot_dir / "BOOTX64.EFI"
-    shutil.copy2(src_efi, dst_efi)
+    startup = br"\EFI\BOOT\BOOTX64.EFI\r\n"
 
-    with open(esp_dir / "startup.nsh", "wb") as f:
-        f.write(br"\EFI\BOOT\BOOTX64.EFI\r\n")
+    def populate(staging: Path) -> None:
+        shutil.copy2(src_efi, staging / "EFI" / "BOOT" / "BOOTX64.EFI")
+        write_small(staging / "startup.nsh", startup)
 
-    run(["qemu-img", "create", "-f", "raw", "target/esp.img", "100M"])
-    run(["mformat", "-i", "target/esp.img", "-F", "::"])
-    for item in esp_dir.iterdir():
-        run(["mcopy", "-i", "target/esp.img", "-s", str(item), "::"])
+    print("Building UEFI image...")
+    build_esp_image(
+        src_efi,
+        [startup],
+        build=lambda: run(
+            ["cargo", "build", "-p", "zap", "--target", "x86_64-unknown-uefi"],
+        ),
+        populate=populate,
+    )
 
     if not path.exists():
         print(f"Image not found: {path}", file=sys.stderr)
@@ -148,37 +254,85 @@ def ensure_image(path: Path) -> None:
 
 
 def unmount_all_linux(disk: Disk) -> None:
-    res = run(["lsblk", "-J", disk.path]).stdout
-    data = json.loads(res)
-    for dev in data.get("blockdevices", []):
-        for ch in dev.get("children", []) or []:
-            mp = ch.get("mountpoint")
-            if mp:
-                print(f"- Unmount {ch.get('name')} from {mp}")
-                run(["sudo", "umount", mp], check=False)
+    for mp in disk.mountpoints:
+        print(f"- Unmount {mp}")
+        run(["sudo", "umount", mp], check=False, capture=False)
+
+
+def _raw_copy(image: Path, dev: str) -> None:
+    size = image.stat().st_size
+    src = os.open(image, os.O_RDONLY)
+    try:
+        dst = os.open(dev, os.O_WRONLY)
+        try:
+            # macOS raw (/dev/r*) character devices only take whole sectors, so
+            # pad the tail to the device block size there; block devices don't.
+            st = os.fstat(dst)
+            block = st.st_blksize if stat.S_ISCHR(st.st_mode) else 1
+
+            def copy_chunk(offset: int) -> None:
+                data = os.pread(src, RAW_CHUNK, offset)
+                if len(data) % block:
+                    data += bytes(block - len(data) % block)
+                view = memoryview(data)
+                written = 0
+                while written < len(view):
+                    written += os.pwrite(dst, view[written:], offset + written)
+
+            # Keep several chunks in flight instead of dd's one read, one write,
+            # but never queue more than RAW_DEPTH so a failed write stops the copy.
+            with ThreadPoolExecutor(max_workers=RAW_DEPTH) as ex:
+                pending: set[Future] = set()
+                for offset in range(0, size, RAW_CHUNK):
+                    if len(pending) >= RAW_DEPTH:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            fut.result()
+                    pending.add(ex.submit(copy_chunk, offset))
+                for fut in pending:
+                    fut.result()
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+
+def write_image(image: Path, dev: str) -> None:
+    if os.geteuid() == 0:
+        print(f"- Writing {image} to {dev}")
+        _raw_copy(image, dev)
+        return
+    cmd = [
+        "sudo",
+        sys.executable,
+        str(Path(__file__).resolve()),
+        "--write-raw",
+        str(image.resolve()),
+        dev,
+    ]
+    print("- Running:", " ".join(shlex.quote(c) for c in cmd))
+    run(cmd, capture=False)
 
 
 def flash_macos(image: Path, disk: Disk) -> None:
     print(f"Using macOS disk: {disk.path} ({disk.size}, {disk.model})")
-    run(["diskutil", "unmountDisk", disk.path])
-    of = disk.display_path
-    dd_cmd = ["sudo", "dd", f"if={image}", f"of={of}", "bs=1m", "conv=sync"]
-    print("- Running:", " ".join(shlex.quote(c) for c in dd_cmd))
-    run(dd_cmd)
-    run(["sync"], check=False)
-    run(["diskutil", "eject", disk.path], check=False)
+    run(["diskutil", "unmountDisk", disk.path], capture=False)
+    write_image(image, disk.display_path)
+    run(["sync"], check=False, capture=False)
+    run(["diskutil", "eject", disk.path], check=False, capture=False)
     print("Done. You can now remove the USB drive.")
 
 
 def flash_linux(image: Path, disk: Disk) -> None:
     print(f"Using Linux disk: {disk.path} ({disk.size}, {disk.model})")
     unmount_all_linux(disk)
-    dd_cmd = ["sudo", "dd", f"if={image}", f"of={disk.path}", "bs=4M", "conv=fsync"]
-    print("- Running:", " ".join(shlex.quote(c) for c in dd_cmd))
-    run(dd_cmd)
-    run(["sync"], check=False)
-    if shutil.which("udisksctl"):
-        run(["udisksctl", "power-off", "-b", disk.path], check=False)
+    write_image(image, disk.path)
+    run(["sync"], check=False, capture=False)
+    if _which("udisksctl"):
+        run(
+            ["udisksctl", "power-off", "-b", disk.path], check=False, capture=False
+        )
     print("Done. You can now remove the USB drive.")
 
 
@@ -229,8 +383,18 @@ def main() -> None:
         action="store_true",
         help="Include internal disks in selection (dangerous)",
     )
+    parser.add_argument(
+        "--write-raw",
+        nargs=2,
+        metavar=("IMAGE", "DEVICE"),
+        help=argparse.SUPPRESS,
+    )
     args = parser.parse_args()
 
+    if args.write_raw:
+        _raw_copy(Path(args.write_raw[0]), args.write_raw[1])
+        return
+
     image = Path(args.image)
     ensure_image(image)
 
@@ -242,6 +406,7 @@ def main() -> None:
             sys.exit(2)
         disk = choose_disk(disks, include_internal=args.include_internal)
         confirm_destruction(disk, args.yes)
+        _disk_cache.clear()
         flash_macos(image, disk)
     elif sysname == "linux":
         disks = list_disks_linux()
@@ -250,6 +415,7 @@ def main() -> None:
             sys.exit(2)
         disk = choose_disk(disks, include_internal=args.include_internal)
         confirm_destruction(disk, args.yes)
+        _disk_cache.clear()
         flash_linux(image, disk)
     else:
         print(f"Unsupported OS: {platform.system()}")
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import fnmatch
+import hashlib
+import json
 import os
 import sys
 import subprocess
@@ -7,48 +10,75 @@ import shutil
 import re
 from pathlib import Path
 
+from esp_image import build_esp_image, write_small
+
+
+FIRMWARE_CACHE = Path("target/.qemu-paths.json")
+NVRAM_RE = re.compile(r'"nvram-template".*"filename":\s*"([^"]+)"')
+
+
+def scan_pattern(path_pattern):
+    # Expand one component at a time so wildcards in directory names
+    # (e.g. Cellar/qemu/*/share) work; scandir avoids a stat per entry.
+    parts = path_pattern.split(os.sep)
+    candidates = [parts[0] or os.sep]
+    for i, part in enumerate(parts[1:], 1):
+        last = i == len(parts) - 1
+        expanded = []
+        for base in candidates:
+            if "*" not in part:
+                expanded.append(os.path.join(base, part))
+                continue
+            try:
+                with os.scandir(base) as it:
+                    for entry in it:
+                        if not fnmatch.fnmatch(entry.name, part):
+                            continue
+                        if entry.is_file() if last else entry.is_dir():
+                            expanded.append(entry.path)
+            except OSError:
+                continue
+        candidates = expanded
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
 
 def find_file_in_paths(paths):
     for path_pattern in paths:
         if "*" in path_pattern:
-            parent = Path(path_pattern).parent
-            pattern = Path(path_pattern).name
-            if parent.exists():
-                for match in parent.glob(pattern):
-                    if match.is_file():
-                        return str(match)
+            match = scan_pattern(path_pattern)
+            if match:
+                return match
         else:
             if Path(path_pattern).is_file():
                 return path_pattern
     return None
 
 
-def main():
-    code_fd = os.environ.get("CODE_FD")
-    if not code_fd or not Path(code_fd).is_file():
-        code_fd_paths = [
-            "/opt/homebrew/share/qemu/edk2-x86_64-code.fd",
-            "/usr/local/share/qemu/edk2-x86_64-code.fd",
-            "/opt/homebrew/Cellar/qemu/*/share/qemu/edk2-x86_64-code.fd",
-            "/usr/local/Cellar/qemu/*/share/qemu/edk2-x86_64-code.fd",
-        ]
-        code_fd = find_file_in_paths(code_fd_paths)
-
-    vars_fd_template = os.environ.get("VARS_FD_TEMPLATE")
-    if not vars_fd_template or not Path(vars_fd_template).is_file():
-        vars_fd_paths = [
-            "/opt/homebrew/share/qemu/edk2-x86_64-vars.fd",
-            "/usr/local/share/qemu/edk2-x86_64-vars.fd",
-            "/opt/homebrew/Cellar/qemu/*/share/qemu/edk2-x86_64-vars.fd",
-            "/usr/local/Cellar/qemu/*/share/qemu/edk2-x86_64-vars.fd",
-            "/opt/homebrew/share/qemu/edk2-i386-vars.fd",
-            "/usr/local/share/qemu/edk2-i386-vars.fd",
-            "/opt/homebrew/Cellar/qemu/*/share/qemu/edk2-i386-vars.fd",
-            "/usr/local/Cellar/qemu/*/share/qemu/edk2-i386-vars.fd",
-        ]
-        vars_fd_template = find_file_in_paths(vars_fd_paths)
-
-    if not vars_fd_template or not Path(vars_fd_template).is_file():
+def discover_firmware():
+    code_fd_paths = [
+        "/opt/homebrew/share/qemu/edk2-x86_64-code.fd",
+        "/usr/local/share/qemu/edk2-x86_64-code.fd",
+        "/opt/homebrew/Cellar/qemu/*/share/qemu/edk2-x86_64-code.fd",
+        "/usr/local/Cellar/qemu/*/share/qemu/edk2-x86_64-code.fd",
+    ]
+    code_fd = find_file_in_paths(code_fd_paths)
+
+    vars_fd_paths = [
+        "/opt/homebrew/share/qemu/edk2-x86_64-vars.fd",
+        "/usr/local/share/qemu/edk2-x86_64-vars.fd",
+        "/opt/homebrew/Cellar/qemu/*/share/qemu/edk2-x86_64-vars.fd",
+        "/usr/local/Cellar/qemu/*/share/qemu/edk2-x86_64-vars.fd",
+        "/opt/homebrew/share/qemu/edk2-i386-vars.fd",
+        "/usr/local/share/qemu/edk2-i386-vars.fd",
+        "/opt/homebrew/Cellar/qemu/*/share/qemu/edk2-i386-vars.fd",
+        "/usr/local/Cellar/qemu/*/share/qemu/edk2-i386-vars.fd",
+    ]
+    vars_fd_template = find_file_in_paths(vars_fd_paths)
+
+    if not vars_fd_template:
         json_paths = [
             "/opt/homebrew/share/qemu/firmware/60-edk2-x86_64.json",
             "/usr/local/share/qemu/firmware/60-edk2-x86_64.json",
@@ -59,9 +89,7 @@ def main():
                 try:
                     with open(json_path, "r") as f:
                         content = f.read()
-                        match = re.search(
-                            r'"nvram-template".*"filename":\s*"([^"]+)"', content
-                        )
+                        match = NVRAM_RE.search(content)
                         if match:
                             candidate = match.group(1)
                             if Path(candidate).is_file():
@@ -70,6 +98,66 @@ def main():
                 except Exception:
                     continue
 
+    return code_fd, vars_fd_template
+
+
+def qemu_version_key():
+    try:
+        out = subprocess.run(
+            ["qemu-system-x86_64", "--version"], capture_output=True
+        ).stdout
+    except OSError:
+        return None
+    return hashlib.sha256(out).hexdigest()
+
+
+def load_cached_firmware(key):
+    try:
+        with open(FIRMWARE_CACHE, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("qemu") != key:
+        return None
+    code_fd = data.get("code_fd")
+    vars_fd_template = data.get("vars_fd_template")
+    if not code_fd or not Path(code_fd).is_file():
+        return None
+    if vars_fd_template and not Path(vars_fd_template).is_file():
+        return None
+    return code_fd, vars_fd_template
+
+
+def save_cached_firmware(key, code_fd, vars_fd_template):
+    try:
+        FIRMWARE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(FIRMWARE_CACHE, "w") as f:
+            json.dump(
+                {"qemu": key, "code_fd": code_fd, "vars_fd_template": vars_fd_template},
+                f,
+            )
+    except OSError:
+        pass
+
+
+def main():
+    code_fd = os.environ.get("CODE_FD")
+    vars_fd_template = os.environ.get("VARS_FD_TEMPLATE")
+    code_fd_ok = code_fd and Path(code_fd).is_file()
+    vars_fd_ok = vars_fd_template and Path(vars_fd_template).is_file()
+
+    if not code_fd_ok or not vars_fd_ok:
+        key = qemu_version_key()
+        found = load_cached_firmware(key) if key else None
+        if found is None:
+            found = discover_firmware()
+            if key and found[0]:
+                save_cached_firmware(key, *found)
+        if not code_fd_ok:
+            code_fd = found[0]
+        if not vars_fd_ok:
+            vars_fd_template = found[1]
+
     if not code_fd or not Path(code_fd).is_file():
         print(
             "Could not locate edk2-x86_64-code.fd. Set CODE_FD to its path.",
@@ -85,36 +173,24 @@ def main():
         vars_fd_template = None
 
     try:
-        subprocess.run(
-            ["cargo", "build", "-p", "zap", "--target", "x86_64-unknown-uefi"],
-            check=True,
-        )
-
-        esp_dir = Path("target/esp")
-        if esp_dir.exists():
-            shutil.rmtree(esp_dir)
-
-        esp_boot_dir = esp_dir / "EFI" / "BOOT"
-        esp_boot_dir.mkdir(parents=True)
-
-        with open(esp_dir / "hello.txt", "w") as f:
-            f.write("Hello from the filesystem!")
-
         src_efi = Path("target/x86_64-unknown-uefi/debug/zap.efi")
-        dst_efi = esp_boot_dir / "BOOTX64.EFI"
-        shutil.copy2(src_efi, dst_efi)
-
-        with open(esp_dir / "startup.nsh", "wb") as f:
-            f.write(b"\\EFI\\BOOT\\BOOTX64.EFI\r\n")
-
-        subprocess.run(
-            ["qemu-img", "create", "-f", "raw", "target/esp.img", "100M"], check=True
+        hello = b"Hello from the filesystem!"
+        startup = b"\\EFI\\BOOT\\BOOTX64.EFI\r\n"
+
+        def populate(staging):
+            write_small(staging / "hello.txt", hello)
+            shutil.copy2(src_efi, staging / "EFI" / "BOOT" / "BOOTX64.EFI")
+            write_small(staging / "startup.nsh", startup)
+
+        build_esp_image(
+            src_efi,
+            [hello, startup],
+            build=lambda: subprocess.run(
+                ["cargo", "build", "-p", "zap", "--target", "x86_64-unknown-uefi"],
+                check=True,
+            ),
+            populate=populate,
         )
-        subprocess.run(["mformat", "-i", "target/esp.img", "-F", "::"], check=True)
-        for item in esp_dir.iterdir():
-            subprocess.run(
-                ["mcopy", "-i", "target/esp.img", "-s", str(item), "::"], check=True
-            )
 
         if vars_fd_template:
             shutil.copy2(vars_fd_template, "target/edk2_vars.fd")